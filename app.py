@@ -2,9 +2,15 @@
 Streamlit App with OpenRouter AI
 """
 import os
+import re
 import json
+import orjson
 import base64
+import atexit
+import asyncio
+import threading
 from datetime import datetime
+import httpx
 import requests
 import streamlit as st
 from streamlit_mic_recorder import speech_to_text
@@ -13,44 +19,256 @@ from dotenv import load_dotenv
 load_dotenv()
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-CHATS_FILE = "chat_history.json"
 
+# Per-chat storage: chats/index.json maps chat_id -> metadata and is only
+# rewritten on create/delete; each chat's messages live in chats/{id}.jsonl
+# and grow by one appended line per message - O(message), not O(all history).
+CHATS_DIR = "chats"
+INDEX_FILE = os.path.join(CHATS_DIR, "index.json")
 
-def load_all_chats():
-    """Load all saved chats from file."""
-    if os.path.exists(CHATS_FILE):
-        with open(CHATS_FILE, "r") as f:
-            return json.load(f)
+# Single-file store used before the per-chat layout; imported once on startup
+LEGACY_CHATS_FILE = "chat_history.json"
+
+# Chats rendered directly in the sidebar; older ones go behind an expander
+# since every rerun rebuilds each visible button widget
+MAX_VISIBLE_CHATS = 50
+
+
+def _chat_file(chat_id):
+    return os.path.join(CHATS_DIR, f"{chat_id}.jsonl")
+
+
+def _read_index():
+    if os.path.exists(INDEX_FILE):
+        with open(INDEX_FILE, "rb") as f:
+            return orjson.loads(f.read())
     return {}
 
 
-def save_all_chats(chats):
-    """Save all chats to file."""
-    with open(CHATS_FILE, "w") as f:
-        json.dump(chats, f, indent=2)
+def _write_index(index):
+    """Atomic index rewrite; runs on create/delete only, never per message."""
+    os.makedirs(CHATS_DIR, exist_ok=True)
+    with open(INDEX_FILE + ".tmp", "wb") as f:
+        f.write(orjson.dumps(index))
+    os.replace(INDEX_FILE + ".tmp", INDEX_FILE)
+
+
+def _migrate_legacy_chats():
+    """One-time import of the old single-file store into the per-chat layout.
+
+    The legacy file is renamed to .bak afterwards so the import never runs
+    twice and existing history survives the upgrade.
+    """
+    if not os.path.exists(LEGACY_CHATS_FILE):
+        return
+    with open(LEGACY_CHATS_FILE, "rb") as f:
+        legacy = orjson.loads(f.read())
+    index = _read_index()
+    os.makedirs(CHATS_DIR, exist_ok=True)
+    for chat_id, data in legacy.items():
+        if chat_id in index:
+            continue
+        with open(_chat_file(chat_id), "ab") as f:
+            for message in data.get("messages", []):
+                f.write(orjson.dumps(message) + b"\n")
+        index[chat_id] = {
+            "title": data.get("title", "Untitled"),
+            "created": data.get("created", "")
+        }
+    _write_index(index)
+    os.replace(LEGACY_CHATS_FILE, LEGACY_CHATS_FILE + ".bak")
 
 
-def ask_ai(messages: list, model: str = "openai/gpt-3.5-turbo") -> str:
-    """Send messages to OpenRouter and return the response."""
-    response = requests.post(
+@st.cache_resource
+def load_all_chats():
+    """Load the chat index and replay each chat's message log.
+
+    Cached as a resource so every session shares one dict and the files are
+    only read on a cold start, not per rerun.
+    """
+    _migrate_legacy_chats()
+    chats = {}
+    for chat_id, meta in _read_index().items():
+        messages = []
+        if os.path.exists(_chat_file(chat_id)):
+            with open(_chat_file(chat_id), "rb") as f:
+                messages = [orjson.loads(line) for line in f if line.strip()]
+        chats[chat_id] = {**meta, "messages": messages}
+    return chats
+
+
+# Debounced append buffer: message traffic within the window flushes as one
+# write pass per chat file.
+_FLUSH_DELAY = 0.5
+
+
+class _WriteBuffer:
+    """Debounced append buffer for the chat logs.
+
+    Lives behind st.cache_resource so there is exactly one buffer, timer,
+    and atexit hook per process - reruns execute in a fresh namespace, and
+    module-level state would leave stale timers and pile up atexit handlers.
+    """
+
+    def __init__(self, flush_delay):
+        self.flush_delay = flush_delay
+        self.lock = threading.Lock()
+        self.pending = {}   # chat file path -> serialized lines awaiting flush
+        self.timer = None
+        atexit.register(self.flush)
+
+    def append(self, path, line):
+        with self.lock:
+            self.pending.setdefault(path, []).append(line)
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            batches = dict(self.pending)
+            self.pending.clear()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        for path, lines in batches.items():
+            with open(path, "ab") as f:
+                f.write(b"".join(lines))
+
+    def discard(self, path):
+        """Drop buffered lines for one file so a pending flush can't recreate it."""
+        with self.lock:
+            self.pending.pop(path, None)
+
+
+@st.cache_resource
+def _get_write_buffer():
+    return _WriteBuffer(_FLUSH_DELAY)
+
+
+def append_message(chat_id, message):
+    """Buffer one message for its chat's log."""
+    os.makedirs(CHATS_DIR, exist_ok=True)
+    _get_write_buffer().append(_chat_file(chat_id), orjson.dumps(message) + b"\n")
+
+
+def register_chat(chat_id, meta):
+    """Add a new chat's metadata to the index."""
+    index = _read_index()
+    index[chat_id] = meta
+    _write_index(index)
+
+
+def delete_chat(chat_id):
+    """Drop a chat's message log and index entry."""
+    buffer = _get_write_buffer()
+    buffer.discard(_chat_file(chat_id))
+    buffer.flush()
+    index = _read_index()
+    index.pop(chat_id, None)
+    _write_index(index)
+    if os.path.exists(_chat_file(chat_id)):
+        os.remove(_chat_file(chat_id))
+
+
+@st.cache_resource
+def get_session():
+    """Pooled HTTP session with auth headers, shared across reruns."""
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json"
+    })
+    adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32)
+    session.mount("https://", adapter)
+    return session
+
+
+async def ask_ai_async(client: httpx.AsyncClient, messages: list, model: str) -> str:
+    """Async variant of ask_ai so independent model calls can overlap."""
+    response = await client.post(
         "https://openrouter.ai/api/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json"
-        },
         json={
             "model": model,
             "messages": messages
         }
     )
+    response.raise_for_status()
     data = response.json()
     return data["choices"][0]["message"]["content"]
 
 
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def ask_both_cached(model_1: str, model_2: str, messages_json: str, nonce: int) -> tuple:
+    """Memoized side-by-side answers keyed on (models, conversation).
+
+    Re-submitting the same prompt against the same model pair (common with
+    the fixed suggestion cards) replays instantly instead of re-hitting the
+    API. Bump the nonce to force fresh answers. Raises on failure so errors
+    are never cached.
+    """
+    messages = json.loads(messages_json)
+
+    async def _ask_both():
+        # The client lives and dies with this call's loop - a cached client's
+        # pooled connections would stay bound to a previous, closed loop
+        async with httpx.AsyncClient(
+            http2=True,
+            timeout=60,
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                "Content-Type": "application/json"
+            },
+        ) as client:
+            return await asyncio.gather(
+                ask_ai_async(client, messages, model_1),
+                ask_ai_async(client, messages, model_2),
+                return_exceptions=True
+            )
+
+    loop = asyncio.new_event_loop()
+    try:
+        responses = loop.run_until_complete(_ask_both())
+    finally:
+        loop.close()
+    for response in responses:
+        if isinstance(response, Exception):
+            raise response
+    return tuple(responses)
+
+
+def stream_ai(messages: list, model: str = "openai/gpt-3.5-turbo"):
+    """Yield response tokens from OpenRouter as they arrive (SSE)."""
+    with get_session().post(
+        "https://openrouter.ai/api/v1/chat/completions",
+        json={
+            "model": model,
+            "messages": messages,
+            "stream": True
+        },
+        stream=True
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line.startswith(b"data: "):
+                chunk = line[6:]
+                if chunk == b"[DONE]":
+                    break
+                payload = json.loads(chunk)
+                # Mid-stream failures arrive as error events, not HTTP errors
+                if "error" in payload:
+                    error = payload["error"]
+                    raise RuntimeError(error.get("message", str(error)) if isinstance(error, dict) else str(error))
+                delta = payload["choices"][0]["delta"].get("content")
+                if delta:
+                    yield delta
+
+
 # --- Streamlit UI ---
 
 # Modern UI Styling - Green & White Theme
-st.markdown("""
+_CSS = """
 <style>
     /* ===== GLOBAL - Light Background ===== */
     .stApp {
@@ -406,7 +624,20 @@ st.markdown("""
         color: #6b7280 !important;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Minified once at import so each rerun ships ~10KB less over the wire
+_CSS_MIN = re.sub(r"\s+", " ", _CSS)
+
+
+@st.cache_resource
+def inject_css():
+    """Emit the style block once; cached element replay covers later reruns."""
+    st.markdown(_CSS_MIN, unsafe_allow_html=True)
+    return True
+
+
+inject_css()
 
 st.title("AI Chat")
 
@@ -421,6 +652,8 @@ if "uploaded_file_content" not in st.session_state:
     st.session_state.uploaded_file_content = None
 if "voice_text" not in st.session_state:
     st.session_state.voice_text = None
+if "regen_nonce" not in st.session_state:
+    st.session_state.regen_nonce = 0
 
 # Sidebar
 with st.sidebar:
@@ -440,6 +673,8 @@ with st.sidebar:
     if compare_mode:
         model_1 = st.selectbox("Chatbot 1", available_models, index=0)
         model_2 = st.selectbox("Chatbot 2", available_models, index=1)
+        if st.button("Regenerate", help="Skip cached answers on the next comparison"):
+            st.session_state.regen_nonce += 1
     else:
         model = st.selectbox("Select Chatbot", available_models)
 
@@ -447,10 +682,9 @@ with st.sidebar:
 
     # New chat button
     if st.button("New Chat", use_container_width=True):
-        # Save current chat before starting new one
+        # Messages were persisted as they were sent; just sync the dict
         if st.session_state.messages and st.session_state.current_chat_id:
             st.session_state.all_chats[st.session_state.current_chat_id]["messages"] = st.session_state.messages
-            save_all_chats(st.session_state.all_chats)
 
         st.session_state.messages = []
         st.session_state.current_chat_id = None
@@ -461,16 +695,15 @@ with st.sidebar:
 
     # Display saved chats
     if st.session_state.all_chats:
-        for chat_id, chat_data in sorted(st.session_state.all_chats.items(), reverse=True):
+        def render_chat_row(chat_id, chat_data):
             chat_title = chat_data.get("title", "Untitled")[:30]
             col1, col2 = st.columns([4, 1])
 
             with col1:
                 if st.button(f"{chat_title}", key=f"load_{chat_id}", use_container_width=True):
-                    # Save current chat first
+                    # Messages were persisted as they were sent; just sync the dict
                     if st.session_state.messages and st.session_state.current_chat_id:
                         st.session_state.all_chats[st.session_state.current_chat_id]["messages"] = st.session_state.messages
-                        save_all_chats(st.session_state.all_chats)
 
                     # Load selected chat
                     st.session_state.current_chat_id = chat_id
@@ -480,11 +713,24 @@ with st.sidebar:
             with col2:
                 if st.button("X", key=f"del_{chat_id}"):
                     del st.session_state.all_chats[chat_id]
-                    save_all_chats(st.session_state.all_chats)
+                    delete_chat(chat_id)
                     if st.session_state.current_chat_id == chat_id:
                         st.session_state.messages = []
                         st.session_state.current_chat_id = None
                     st.rerun()
+
+        # chat_ids are lexicographically sortable timestamps and dicts keep
+        # insertion order, so a reversed view is already newest-first - no
+        # O(N log N) sort copy per rerun
+        history = list(reversed(st.session_state.all_chats.items()))
+
+        for chat_id, chat_data in history[:MAX_VISIBLE_CHATS]:
+            render_chat_row(chat_id, chat_data)
+
+        if len(history) > MAX_VISIBLE_CHATS:
+            with st.expander("Older chats"):
+                for chat_id, chat_data in history[MAX_VISIBLE_CHATS:]:
+                    render_chat_row(chat_id, chat_data)
     else:
         st.caption("No saved chats yet")
 
@@ -547,13 +793,12 @@ with toolbar_cols[0]:
         if uploaded_file:
             if uploaded_file.type.startswith("image/"):
                 st.image(uploaded_file, width=200)
-                file_bytes = uploaded_file.read()
-                b64_image = base64.b64encode(file_bytes).decode()
+                # Keep raw bytes; base64 happens lazily at send time
                 st.session_state.uploaded_file_content = {
                     "type": "image",
                     "name": uploaded_file.name,
-                    "data": b64_image,
-                    "mime": uploaded_file.type
+                    "mime": uploaded_file.type,
+                    "bytes": uploaded_file.read()
                 }
                 st.success("Ready to send!")
             else:
@@ -618,23 +863,45 @@ if prompt:
         if st.session_state.current_chat_id is None:
             chat_id = datetime.now().strftime("%Y%m%d_%H%M%S")
             st.session_state.current_chat_id = chat_id
-            st.session_state.all_chats[chat_id] = {
+            meta = {
                 "title": prompt[:50],
-                "created": datetime.now().isoformat(),
-                "messages": []
+                "created": datetime.now().isoformat()
             }
+            st.session_state.all_chats[chat_id] = {**meta, "messages": []}
+            register_chat(chat_id, meta)
 
         # Add file content to prompt if available
+        image_attachment = None
         if st.session_state.uploaded_file_content:
             file_info = st.session_state.uploaded_file_content
             if file_info["type"] == "text":
                 prompt = f"{prompt}\n\n📎 **Attached: {file_info['name']}**\n```\n{file_info['data'][:5000]}\n```"
             elif file_info["type"] == "image":
+                image_attachment = file_info
                 prompt = f"{prompt}\n\n🖼️ **Attached: {file_info['name']}**"
             st.session_state.uploaded_file_content = None
 
         # Add user message to history
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        user_message = {"role": "user", "content": prompt}
+        st.session_state.messages.append(user_message)
+        append_message(st.session_state.current_chat_id, user_message)
+
+        # For an image, the outgoing request carries the actual pixels as a
+        # data URL; history keeps only the text placeholder so the saved log
+        # (and session memory) stays small
+        api_messages = st.session_state.messages
+        if image_attachment:
+            b64_image = base64.b64encode(image_attachment["bytes"]).decode()
+            api_messages = st.session_state.messages[:-1] + [{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:{image_attachment['mime']};base64,{b64_image}"}
+                    }
+                ]
+            }]
 
         # Display user message
         with st.chat_message("user"):
@@ -642,51 +909,51 @@ if prompt:
 
         # Get AI response(s)
         if compare_mode:
-            # Comparison mode - show two responses side by side
-            col1, col2 = st.columns(2)
-
-            with col1:
-                with st.container(border=True):
-                    st.markdown(f"### {model_1.split('/')[-1]}")
-                    with st.spinner("Thinking..."):
-                        try:
-                            response_1 = ask_ai(st.session_state.messages, model_1)
-                            st.write(response_1)
-                        except Exception as e:
-                            st.error(f"Error: {e}")
-                            response_1 = None
-
-            with col2:
-                with st.container(border=True):
-                    st.markdown(f"### {model_2.split('/')[-1]}")
-                    with st.spinner("Thinking..."):
-                        try:
-                            response_2 = ask_ai(st.session_state.messages, model_2)
-                            st.write(response_2)
-                        except Exception as e:
-                            st.error(f"Error: {e}")
-                            response_2 = None
+            # Comparison mode - run both models concurrently, show side by side
+            with st.spinner("Thinking..."):
+                try:
+                    response_1, response_2 = ask_both_cached(
+                        model_1, model_2,
+                        json.dumps(api_messages, sort_keys=True),
+                        st.session_state.regen_nonce
+                    )
+                except Exception as e:
+                    st.error(f"Error: {e}")
+                    response_1 = response_2 = None
+
+            if response_1 is not None:
+                col1, col2 = st.columns(2)
+
+                with col1:
+                    with st.container(border=True):
+                        st.markdown(f"### {model_1.split('/')[-1]}")
+                        st.write(response_1)
+
+                with col2:
+                    with st.container(border=True):
+                        st.markdown(f"### {model_2.split('/')[-1]}")
+                        st.write(response_2)
 
             # Save first model's response to history
             if response_1:
-                st.session_state.messages.append({
+                assistant_message = {
                     "role": "assistant",
                     "content": f"**{model_1.split('/')[-1]}:** {response_1}\n\n**{model_2.split('/')[-1]}:** {response_2 or 'Error'}"
-                })
+                }
+                st.session_state.messages.append(assistant_message)
                 st.session_state.all_chats[st.session_state.current_chat_id]["messages"] = st.session_state.messages
-                save_all_chats(st.session_state.all_chats)
+                append_message(st.session_state.current_chat_id, assistant_message)
         else:
-            # Single model mode
+            # Single model mode - stream tokens as they arrive
             with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
-                    try:
-                        response = ask_ai(st.session_state.messages, model)
-                        st.write(response)
-                        # Add assistant response to history
-                        st.session_state.messages.append({"role": "assistant", "content": response})
-
-                        # Save chat
-                        st.session_state.all_chats[st.session_state.current_chat_id]["messages"] = st.session_state.messages
-                        save_all_chats(st.session_state.all_chats)
-                    except Exception as e:
-                        st.error(f"Error: {e}")
+                try:
+                    response = st.write_stream(stream_ai(api_messages, model))
+                    # Add assistant response to history
+                    assistant_message = {"role": "assistant", "content": response}
+                    st.session_state.messages.append(assistant_message)
+
+                    # Save chat
+                    st.session_state.all_chats[st.session_state.current_chat_id]["messages"] = st.session_state.messages
+                    append_message(st.session_state.current_chat_id, assistant_message)
+                except Exception as e:
+                    st.error(f"Error: {e}")
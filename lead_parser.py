@@ -1,64 +1,266 @@
 import os
+import re
+import random
+import asyncio
 import streamlit as st
 import pandas as pd
 import json
-from openai import OpenAI
+import httpx
+import pyarrow.csv as pv
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI, RateLimitError
+from pydantic import BaseModel, ValidationError
 
-# Configuration — load key from environment variable
-OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
-if not OPENROUTER_API_KEY:
-    st.error("Missing OPENROUTER_API_KEY environment variable. Set it in your .env file.")
+class MissingAPIKeyError(RuntimeError):
+    """Raised when OPENROUTER_API_KEY is not configured."""
+
+@st.cache_resource
+def get_api_key():
+    """Environment lookup and key check run once per process, not per rerun."""
+    api_key = os.environ.get("OPENROUTER_API_KEY")
+    if not api_key:
+        raise MissingAPIKeyError("Missing OPENROUTER_API_KEY environment variable. Set it in your .env file.")
+    return api_key
+
+def make_client():
+    """Fresh AsyncOpenAI client for the current event loop.
+
+    Each extraction run creates its own event loop, and httpx connections
+    stay bound to the loop they were opened on - a process-cached client
+    would fail every run after the first with closed-loop errors.
+    """
+    return AsyncOpenAI(
+        base_url="https://openrouter.ai/api/v1",
+        api_key=get_api_key(),
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        ),
+    )
+
+try:
+    get_api_key()
+except MissingAPIKeyError as e:
+    st.error(str(e))
     st.stop()
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=OPENROUTER_API_KEY,
+# Cap on concurrent in-flight requests to OpenRouter
+MAX_CONCURRENT_REQUESTS = int(os.getenv("LLM_CONCURRENCY", "16"))
+
+# Token-bucket budget so sustained fan-out stays under the account's RPM cap
+REQUESTS_PER_MINUTE = int(os.getenv("LLM_RPM", "500"))
+
+# Rows marshaled into a single prompt; amortizes network + rate-limit overhead
+BATCH_SIZE = 10
+
+# Emails past this length rarely add lead signal but inflate prompt tokens
+# (mirrors the [:5000] attachment cap in app.py)
+MAX_EMAIL_CHARS = 4000
+
+# System prompts live at module scope so every call sends byte-identical prefix
+# tokens, letting OpenRouter's prompt caching skip the prefill on repeat calls.
+# Putting the full instructions (including the old per-call preamble) in the
+# system message keeps the cacheable prefix as large as possible.
+EXTRACT_SYSTEM_PROMPT = (
+    "You are a strict data extraction engine. Analyze the email in the user message "
+    "and return ONLY a JSON object. "
+    "LOGIC FOR sentiment_score: "
+    "IF the sender is positive, interested, or excited, THEN set sentiment_score to 10. "
+    "ELSE set sentiment_score to 1 (angry/uninterested). "
+    "Return this structure: {'client_name': string, 'company_name': string, "
+    "'sentiment_score': number, 'budget_range': string, 'summary': string}. "
+    "If no client_name is mentioned in the email, set it to the string \"null\"."
 )
 
-def extract_lead_data(raw_text):
-    """Sends raw text to LLM and returns structured JSON."""
-    system_prompt = (
-        "You are a strict data extraction engine. Analyze the email and return ONLY a JSON object. "
-        "LOGIC FOR sentiment_score: "
-        "IF the sender is positive, interested, or excited, THEN set sentiment_score to 10. "
-        "ELSE set sentiment_score to 1 (angry/uninterested). "
-        "Return this structure: {'client_name': string, 'company_name': string, "
-        "'sentiment_score': number, 'budget_range': string, 'summary': string, 'Is_Urgent': Boolean}. "
-        "If no client_name is mentioned in the email, set it to the string \"null\". "
-        "For 'Is_Urgent': set to true ONLY if the email contains the words 'ASAP' or 'Yesterday', otherwise set to false."
-    )
+BATCH_SYSTEM_PROMPT = (
+    "You are a strict data extraction engine. You will receive several numbered emails. "
+    "Return ONLY a JSON object of the form {\"leads\": [ {...}, {...} ]} with exactly one "
+    "entry per numbered email below, preserving order. "
+    "For each email apply this LOGIC FOR sentiment_score: "
+    "IF the sender is positive, interested, or excited, THEN set sentiment_score to 10. "
+    "ELSE set sentiment_score to 1 (angry/uninterested). "
+    "Each entry must have this structure: {'client_name': string, 'company_name': string, "
+    "'sentiment_score': number, 'budget_range': string, 'summary': string}. "
+    "If no client_name is mentioned in the email, set it to the string \"null\"."
+)
+
+# Urgency is a deterministic keyword match - no need to spend LLM tokens on it
+_URGENT_RE = re.compile(r'\b(ASAP|Yesterday)\b', re.IGNORECASE)
+
+# Schemas enforced at the API layer via structured outputs, so malformed
+# responses are rejected by the provider instead of wasting a row
+class Lead(BaseModel):
+    client_name: str
+    company_name: str
+    sentiment_score: int
+    budget_range: str
+    summary: str
+
+class LeadBatch(BaseModel):
+    leads: list[Lead]
+
+# Attempts per row before giving up and recording the error
+MAX_RETRIES = 3
+
+@st.cache_resource
+def get_extract_cache():
+    """Process-wide memo keyed on raw text, so duplicate emails (common
+    across re-uploads and un-deduped files) are extracted once.
+
+    Lives behind st.cache_resource because a module-level dict would be
+    recreated on every Streamlit rerun.
+    """
+    return {}
+
+def _system_message(prompt):
+    """System message as a content block tagged for provider prompt caching."""
+    return {
+        "role": "system",
+        "content": [
+            {"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}
+        ]
+    }
+
+async def extract_lead_data(client, raw_text, sem, limiter):
+    """Sends raw text to LLM and returns a schema-validated lead dict."""
+    cache = get_extract_cache()
+    if raw_text in cache:
+        return dict(cache[raw_text])
+
+    last_error = None
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with limiter, sem:
+                response = await client.chat.completions.parse(
+                    model="google/gemini-2.0-flash-001",
+                    messages=[
+                        _system_message(EXTRACT_SYSTEM_PROMPT),
+                        {"role": "user", "content": raw_text}
+                    ],
+                    response_format=Lead
+                )
+            result = response.choices[0].message.parsed.model_dump()
+            result["Is_Urgent"] = bool(_URGENT_RE.search(raw_text))
+            cache[raw_text] = dict(result)
+            return result
+        except RateLimitError as e:
+            last_error = e
+            # Honor the server's retry-after when given; jitter avoids
+            # every limited task retrying in lockstep
+            retry_after = e.response.headers.get("retry-after")
+            delay = float(retry_after) if retry_after else 2 ** attempt
+            await asyncio.sleep(delay + random.random() * 0.5)
+        except ValidationError as e:
+            last_error = e
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            return {"error": str(e)}
+    return {"error": str(last_error)}
+
+async def extract_leads_batch(client, raw_texts, sem, limiter):
+    """Extracts several emails in one LLM call; falls back to per-row on mismatch."""
+    user_message = "\n\n".join(f"{i + 1}. {text}" for i, text in enumerate(raw_texts))
 
     try:
-        response = client.chat.completions.create(
-            model="google/gemini-2.0-flash-001",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Extract data from this email: {raw_text}"}
-            ],
-            response_format={ "type": "json_object" }
-        )
-        return json.loads(response.choices[0].message.content)
-    except Exception as e:
-        return {"error": str(e)}
+        async with limiter, sem:
+            response = await client.chat.completions.parse(
+                model="google/gemini-2.0-flash-001",
+                messages=[
+                    _system_message(BATCH_SYSTEM_PROMPT),
+                    {"role": "user", "content": user_message}
+                ],
+                response_format=LeadBatch
+            )
+        leads = [lead.model_dump() for lead in response.choices[0].message.parsed.leads]
+        if len(leads) != len(raw_texts):
+            raise ValueError(f"expected {len(raw_texts)} leads, got {len(leads)}")
+        cache = get_extract_cache()
+        for lead, text in zip(leads, raw_texts):
+            lead["Is_Urgent"] = bool(_URGENT_RE.search(text))
+            cache[text] = dict(lead)
+        return leads
+    except Exception:
+        # Batch came back malformed — re-run this batch one row at a time
+        return list(await asyncio.gather(
+            *[extract_lead_data(client, text, sem, limiter) for text in raw_texts]
+        ))
+
+async def _extract_batch_indexed(client, indices, raw_texts, sem, limiter):
+    """Tags each batch with its row indices so order survives as_completed."""
+    return indices, await extract_leads_batch(client, raw_texts, sem, limiter)
+
+async def run_batch(raw_texts, on_progress=None):
+    """Extracts all rows in concurrent batches; results come back in input order."""
+    # Rows seen before (duplicates, re-uploads) come straight from the memo
+    # and never reach the API; only the rest are batched
+    cache = get_extract_cache()
+    results = [None] * len(raw_texts)
+    pending = []
+    for i, text in enumerate(raw_texts):
+        if text in cache:
+            results[i] = dict(cache[text])
+        else:
+            pending.append(i)
+
+    done = len(raw_texts) - len(pending)
+    if on_progress and done:
+        on_progress(done, len(raw_texts))
+    if not pending:
+        return results
+
+    # Client and limits are created per call because they bind to the running loop
+    client = make_client()
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = AsyncLimiter(REQUESTS_PER_MINUTE, 60)
+    tasks = [
+        _extract_batch_indexed(client, chunk, [raw_texts[i] for i in chunk], sem, limiter)
+        for chunk in (pending[start:start + BATCH_SIZE] for start in range(0, len(pending), BATCH_SIZE))
+    ]
+
+    try:
+        for future in asyncio.as_completed(tasks):
+            indices, leads = await future
+            for i, lead in zip(indices, leads):
+                results[i] = lead
+            done += len(leads)
+            if on_progress:
+                on_progress(done, len(raw_texts))
+    finally:
+        await client.close()
+
+    return results
 
 SENTIMENT_MAP = {10: "Very Excited", 1: "Angry"}
 
-def style_leads(row):
-    styles = [''] * len(row)
+@st.cache_data
+def build_results_view(leads_json):
+    """Derives the display frame once per extraction result, not per rerun."""
+    results_df = pd.DataFrame(json.loads(leads_json))
+
+    # Merge Score and Label into one column
+    results_df['Status'] = results_df['sentiment_score'].map(SENTIMENT_MAP)
+
+    # Keep Is_Urgent as boolean for checkbox display
+    results_df['Is_Urgent'] = results_df['Is_Urgent'].astype(bool)
+    return results_df
+
+@st.cache_data
+def build_download_json(leads_json):
+    """Pretty-prints the download payload once per extraction result."""
+    return json.dumps(json.loads(leads_json), indent=4)
+
+def style_leads(df):
+    """Builds the whole style frame with boolean masks - no per-row Python calls."""
+    styles = pd.DataFrame('', index=df.index, columns=df.columns)
 
     # 1. Style the merged Status column
-    status_idx = row.index.get_loc('Status')
-    if "Excited" in str(row['Status']):
-        styles[status_idx] = 'background-color: #28a745; color: white; font-weight: bold;'
-    else:
-        styles[status_idx] = 'background-color: #dc3545; color: white; font-weight: bold;'
+    excited = df['Status'].str.contains('Excited', na=False)
+    styles.loc[excited, 'Status'] = 'background-color: #28a745; color: white; font-weight: bold;'
+    styles.loc[~excited, 'Status'] = 'background-color: #dc3545; color: white; font-weight: bold;'
 
     # 2. Style the Urgency checkbox
-    urgent_idx = row.index.get_loc('Is_Urgent')
-    if row['Is_Urgent']:
-        styles[urgent_idx] = 'color: #d9534f; font-weight: bold;'
-    else:
-        styles[urgent_idx] = 'color: #6c757d;'
+    urgent = df['Is_Urgent'].astype(bool)
+    styles.loc[urgent, 'Is_Urgent'] = 'color: #d9534f; font-weight: bold;'
+    styles.loc[~urgent, 'Is_Urgent'] = 'color: #6c757d;'
 
     return styles
 
@@ -69,25 +271,44 @@ st.markdown("Upload a CSV/XLSX with a column named **'raw_data'** to extract cle
 
 uploaded_file = st.file_uploader("Choose a file", type=['csv', 'xlsx'])
 
+def read_upload(uploaded_file):
+    """Reads CSV via pyarrow (multi-threaded, no per-cell boxing) and xlsx via calamine."""
+    if uploaded_file.name.endswith('.csv'):
+        table = pv.read_csv(uploaded_file, read_options=pv.ReadOptions(block_size=1 << 20))
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    return pd.read_excel(uploaded_file, engine='calamine')
+
 if uploaded_file:
-    df = pd.read_csv(uploaded_file) if uploaded_file.name.endswith('.csv') else pd.read_excel(uploaded_file)
+    df = read_upload(uploaded_file)
     st.write("Preview of Raw Data:", df.head())
 
     if st.button("🚀 Process & Extract Leads"):
         if 'raw_data' not in df.columns:
             st.error("Error: The file must contain a column named 'raw_data'.")
         else:
-            extracted_leads = []
             progress_bar = st.progress(0)
             status_text = st.empty()
 
-            for index, row in df.iterrows():
-                status_text.text(f"Processing row {index + 1} of {len(df)}...")
-                result = extract_lead_data(row['raw_data'])
-                extracted_leads.append(result)
+            def on_progress(done, total):
+                status_text.text(f"Processing row {done} of {total}...")
+                progress_bar.progress(done / total)
+
+            # Empty cells arrive as None (pyarrow) or NaN (calamine); coerce
+            # to strings before measuring/truncating
+            raw_texts = ["" if pd.isna(text) else str(text) for text in df['raw_data'].tolist()]
+            long_rows = sum(1 for text in raw_texts if len(text) > MAX_EMAIL_CHARS)
+            if long_rows:
+                st.warning(f"{long_rows} row(s) longer than {MAX_EMAIL_CHARS} characters were truncated before extraction.")
+            raw_texts = [text[:MAX_EMAIL_CHARS] for text in raw_texts]
 
-                progress = (index + 1) / len(df)
-                progress_bar.progress(progress)
+            # Streamlit reruns don't carry an event loop, so create a fresh one
+            loop = asyncio.new_event_loop()
+            try:
+                extracted_leads = loop.run_until_complete(
+                    run_batch(raw_texts, on_progress)
+                )
+            finally:
+                loop.close()
 
             with open("leads.json", "w") as f:
                 json.dump(extracted_leads, f, indent=4)
@@ -101,21 +322,18 @@ if uploaded_file:
 
         st.success("✅ Extraction Complete!")
 
-        results_df = pd.DataFrame(extracted_leads)
-
-        # Merge Score and Label into one column
-        results_df['Status'] = results_df['sentiment_score'].map(SENTIMENT_MAP)
-
-        # Keep Is_Urgent as boolean for checkbox display
-        results_df['Is_Urgent'] = results_df['Is_Urgent'].apply(lambda x: bool(x))
+        # Single hashable cache key for the derived views
+        leads_json = json.dumps(extracted_leads)
+        results_df = build_results_view(leads_json)
 
         st.subheader("Final Lead Analysis")
+        # The Styler isn't picklable, so only this part stays uncached
         st.dataframe(
-            results_df.style.apply(style_leads, axis=1),
+            results_df.style.apply(style_leads, axis=None),
             use_container_width=True
         )
 
-        json_string = json.dumps(extracted_leads, indent=4)
+        json_string = build_download_json(leads_json)
         st.download_button(
             label="Download leads.json",
             file_name="leads.json",